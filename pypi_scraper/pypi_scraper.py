@@ -4,43 +4,119 @@
 Scrape the PyPI Index and download all the package data.
 """
 
-from bs4 import BeautifulSoup
+from lxml import etree
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError
-import json
-from time import sleep
+import orjson
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+from time import sleep, monotonic
+import queue
 import random
+import re
+import threading
 from scutils.log_factory import LogFactory
 from os import getenv
-from os import listdir
-from os.path import isfile, join
+from os import replace
+from os import scandir
 import traceback
 from retrying import retry
 
+# Only links in the updated-packages table point below /pypi/, so this
+# prefix is enough to tell them apart from the navigation links
+PACKAGE_HREF_PREFIX = '/pypi/'
+
+# PEP 503 simple index pages link each project below /simple/ instead
+SIMPLE_HREF_PREFIX = '/simple/'
+
+# Package links on the known PyPI markup always look like
+# <a href="/pypi/<name>/<version>">, so the names can be pulled out of
+# the raw bytes in one native regex pass with no HTML parse at all
+PACKAGE_HREF_RE = re.compile(rb'<a[^>]+href="/pypi/([^/"]+)/')
+
+# Media type for the json form of the simple index (PEP 691)
+SIMPLE_INDEX_JSON = 'application/vnd.pypi.simple.v1+json'
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity):
+        """
+        Thread-safe token bucket used to rate limit outbound requests.
+
+        :param float rate: tokens added per second
+        :param float capacity: maximum number of tokens the bucket holds
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last_refill = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping until one is available."""
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                time_to_wait = (1 - self._tokens) / self.rate
+
+            sleep(time_to_wait)
+
 
 class PyPIScraper(object):
 
     def __init__(self,
                  pypi_source_page='https://pypi.python.org/pypi',
+                 pypi_simple_index='https://pypi.python.org/simple/',
                  base_save_path='/usr/src/app/data',
                  log_level='INFO',
                  log_dir='/var/log/rulemanager',
-                 log_file_name='rulemanager.log'):
+                 log_file_name='rulemanager.log',
+                 max_workers=16,
+                 requests_per_second=5):
         """
         PyPI Scraper base class.
 
         :param str pypi_source_page: PyPI homepage url
+        :param str pypi_simple_index: url of the simple package index
         :param str base_save_path: full path without the trailing slash to the directory to save the json files to
         :param str log_level: logging level
         :param str log_dir: full path to log file directory
         :param str log_file_name: log file name
+        :param int max_workers: number of threads fetching package data concurrently
+        :param float requests_per_second: average outbound request rate to stay under
         """
 
         self.pypi_source_page = pypi_source_page
+        self.pypi_simple_index = pypi_simple_index
         self.base_save_path = base_save_path
         self.log_level = log_level
         self.log_dir = log_dir
         self.log_file_name = log_file_name
+        self.max_workers = max_workers
+        self.requests_per_second = requests_per_second
+
+        # Precomputed once so the hot loop builds each package url with
+        # plain concatenation instead of re-parsing a format string
+        self._pkg_url_prefix = self.pypi_source_page + "/"
+        self._pkg_url_suffix = "/json"
+
+        # Cache validators for the index page so unchanged cycles can be
+        # answered with a 304 and skip the download and parse entirely
+        self._index_etag = None
+        self._index_last_modified = None
+        self._index_not_modified = False
+        self._index_content_type = ''
+        self._cached_package_list = []
 
     def _setup(self):
         """Create the logger and set up the rest of the configuration."""
@@ -51,6 +127,39 @@ class PyPIScraper(object):
                                               dir=self.log_dir,
                                               file=self.log_file_name)
 
+        # Reuse a single session for all requests so the connection to
+        # PyPI is kept alive instead of paying the TCP + TLS handshake
+        # for every package. Created once; _setup runs again on every
+        # cycle of the daemon loop.
+        if getattr(self, 'session', None) is None:
+            self.session = requests.Session()
+            self.session.headers.update({
+                'User-Agent': 'pypi-scraper',
+                'Accept': 'application/json',
+                'Accept-Encoding': 'gzip, deflate'
+            })
+            # Size the connection pool to the worker count so every
+            # fetch thread gets a warm keep-alive connection
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=self.max_workers)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+
+        # Single writer thread fed by a bounded queue so disk writes
+        # overlap with the network fetches without buffering a whole run
+        # in memory. Created once; _setup runs again on every cycle of
+        # the daemon loop.
+        if getattr(self, '_write_q', None) is None:
+            self._write_q = queue.Queue(maxsize=100)
+            self._writer_thread = threading.Thread(target=self._writer_loop,
+                                                   daemon=True)
+            self._writer_thread.start()
+
+        # Enforce politeness as an average request rate rather than a
+        # fixed sleep per package, so in-flight requests can overlap
+        self._rate_limiter = TokenBucket(rate=self.requests_per_second,
+                                         capacity=self.requests_per_second)
+
     def _retry_if_requests_connection_error(exception):
         """Retry the request if the requests request produced a connection error."""
         return isinstance(exception, ConnectionError)
@@ -59,15 +168,15 @@ class PyPIScraper(object):
         """
         Get the list of existing packages.
 
-        :return: retrieved_packages: list of existing package names
+        :return: retrieved_packages: set of existing package names
         """
-        current_files = [
-            f for f in listdir(self.base_save_path)
-            if isfile(join(self.base_save_path, f))
-        ]
-        retrieved_packages = [
-            f[:-5] for f in current_files
-        ]
+        # scandir answers is_file from the directory entry itself, so
+        # listing the data directory costs no stat call per file
+        with scandir(self.base_save_path) as entries:
+            retrieved_packages = {
+                entry.name[:-5] for entry in entries
+                if entry.name.endswith('.json') and entry.is_file(follow_symlinks=False)
+            }
 
         return retrieved_packages
 
@@ -75,23 +184,45 @@ class PyPIScraper(object):
            wait_exponential_multiplier=500,
            wait_exponential_max=10000,
            stop_max_attempt_number=5)
-    def _get_pypi_homepage(self):
+    def _get_package_index(self):
         """
-        Get the PyPI homepage
+        Get the PyPI package index.
+
+        Asks the simple index for its json form; servers that don't
+        support it answer with HTML, which run() routes to the HTML
+        extractor instead.
 
-        :return html_to_parse: HTML of the PyPI homepage, or None
+        :return index_payload: body of the package index, or None
         """
         try:
-            self.logger.info("Getting the PyPI homepage")
-            response = requests.get(self.pypi_source_page)
+            self.logger.info("Getting the PyPI package index")
+
+            headers = {'Accept': SIMPLE_INDEX_JSON}
+            if self._index_etag:
+                headers['If-None-Match'] = self._index_etag
+            if self._index_last_modified:
+                headers['If-Modified-Since'] = self._index_last_modified
+
+            self._index_not_modified = False
+            response = self.session.get(self.pypi_simple_index, headers=headers)
+
+            if response.status_code == 304:
+                self.logger.info("Package index not modified since the last run")
+                self._index_not_modified = True
+                return None
 
             if 200 <= response.status_code < 300:
-                html_to_parse = response.content
-                return html_to_parse
+                # Remember the validators so the next cycle can make a
+                # conditional request
+                self._index_etag = response.headers.get('ETag')
+                self._index_last_modified = response.headers.get('Last-Modified')
+                self._index_content_type = response.headers.get('Content-Type', '')
+                index_payload = response.content
+                return index_payload
             else:
                 return None
         except Exception as e:
-            self.logger.error("Caught exception retrieving the PyPI homepage", extra={
+            self.logger.error("Caught exception retrieving the package index", extra={
                 'error_type': 'RequestsError',
                 'ex': traceback.format_exc()
             })
@@ -105,18 +236,50 @@ class PyPIScraper(object):
         :param html_to_parse: html source code used to extract the package names
         :return packages_to_retrieve: list of package names
         """
-        soup = BeautifulSoup(html_to_parse, 'html.parser')
-
         self.logger.info("Extracting package names")
 
+        if isinstance(html_to_parse, str):
+            html_to_parse = html_to_parse.encode('utf-8')
+
+        # Fast path for the known markup; if it matches nothing the
+        # page shape has drifted and the real parser below decides
         package_names = [
-            link.get('href').split('/')[2]
-            for link in soup.find('table', class_='list').find_all('a')
-            if link is not None
+            match.group(1).decode('utf-8')
+            for match in PACKAGE_HREF_RE.finditer(html_to_parse)
         ]
 
+        if package_names:
+            return package_names
+
+        # Stream the parse and drop each element as soon as its href has
+        # been read, so peak memory stays flat no matter how large the
+        # index page grows
+        package_names = []
+        for _, element in etree.iterparse(BytesIO(html_to_parse), html=True, tag='a'):
+            href = element.get('href')
+            if href is not None and (href.startswith(PACKAGE_HREF_PREFIX) or
+                                     href.startswith(SIMPLE_HREF_PREFIX)):
+                package_names.append(href.split('/')[2])
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
         return package_names
 
+    def _get_list_of_packages_from_simple_index(self, index_payload):
+        """
+        Build the list of packages from a json simple index payload.
+
+        :param index_payload: json body returned by the simple index
+        :return packages_to_retrieve: list of package names
+        """
+        self.logger.info("Extracting package names")
+
+        return [
+            project['name']
+            for project in orjson.loads(index_payload)['projects']
+        ]
+
     @retry(retry_on_exception=_retry_if_requests_connection_error,
            wait_exponential_multiplier=500,
            wait_exponential_max=10000,
@@ -128,14 +291,16 @@ class PyPIScraper(object):
         :param package: name of the package to retrieve the data for
         :return package_in_json: package data in json format, or None
         """
-        url = self.pypi_source_page + "/{}/json".format(package)
+        url = self._pkg_url_prefix + package + self._pkg_url_suffix
     
         try:
             self.logger.info("Retrieving data for: {}".format(package))
-            package_page_response = requests.get(url)
+            package_page_response = self.session.get(url)
 
             if 200 <= package_page_response.status_code < 300:
-                package_in_json = package_page_response.json()
+                # orjson decodes the raw bytes in C, skipping the
+                # bytes -> str -> dict round trip response.json() does
+                package_in_json = orjson.loads(package_page_response.content)
                 return package_in_json
             else:
                 return None
@@ -147,19 +312,76 @@ class PyPIScraper(object):
             if isinstance(e, ConnectionError):
                 raise
 
-    def _save_package_data_to_disk(self, package_data):
+    def _writer_loop(self):
+        """Pull serialized package buffers off the queue and write them."""
+        while True:
+            item = self._write_q.get()
+
+            if item is None:
+                self._write_q.task_done()
+                break
+
+            file_name, buf = item
+            try:
+                self._write_package_file(file_name, buf)
+            finally:
+                self._write_q.task_done()
+
+    def _write_package_file(self, file_name, buf):
+        """
+        Write a serialized package buffer to disk.
+
+        :param file_name: full path of the file to write
+        :param buf: serialized package data as bytes
+        """
+        try:
+            # Write to a temp name and rename into place so a crash
+            # mid-write never leaves a truncated .json file behind for
+            # the skip-existing set to mistake for a complete one
+            temp_name = file_name + '.tmp'
+            with open(temp_name, 'wb') as outfile:
+                outfile.write(buf)
+            replace(temp_name, file_name)
+        except Exception:
+            self.logger.error("Caught exception writing package data to disk", extra={
+                'error_type': 'FileWriteError',
+                'file_name': file_name,
+                'ex': traceback.format_exc()
+            })
+
+    def _fetch_package(self, package):
+        """
+        Politely retrieve the json data for a single package.
+
+        :param package: name of the package to retrieve the data for
+        :return package_in_json: package data in json format, or None
+        """
+        self._rate_limiter.acquire()
+
+        return self._get_json_data_for_package(package)
+
+    def _save_package_data_to_disk(self, package_data, package=None):
         """
         Save the package data to disk.
 
         :param package_data: package data in json format
+        :param package: name the package was fetched under; falls back to
+            the registered name in the package data
         :return boolean: True if successful, False if not
         """
         try:
-            package_name = package_data.get('info', {}).get('name', None)
+            # File names must match the names the index hands out, or
+            # the skip-existing diff never recognizes the file (the
+            # simple index serves normalized names like flask while the
+            # registered name can be Flask)
+            package_name = package or package_data.get('info', {}).get('name', None)
             file_name = self.base_save_path + "/{}.json".format(package_name)
             self.logger.info("Saving data for: {}".format(package_name))
-            with open(file_name, 'w') as outfile:
-                json.dump(package_data, outfile, indent=2, sort_keys=True, separators=(',', ':'))
+            # Serialize in one shot and write the whole buffer with a
+            # single write call instead of one write per json token
+            buf = orjson.dumps(package_data,
+                               option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+            self._write_q.put((file_name, buf))
         except Exception as e:
             self.logger.error("Caught exception retrieving the PyPI homepage", extra={
                 'error_type': 'JSONError',
@@ -169,6 +391,13 @@ class PyPIScraper(object):
 
         return True
 
+    def close(self):
+        """Flush any pending writes and stop the writer thread."""
+        if getattr(self, '_write_q', None) is not None:
+            self._write_q.put(None)
+            self._writer_thread.join()
+            self._write_q = None
+
     def run(self):
         """
         Run the Pypi updater.
@@ -177,32 +406,68 @@ class PyPIScraper(object):
 
         self.logger.info("Starting update")
 
-        html_to_parse = self._get_pypi_homepage()
-
-        if html_to_parse:
-            package_list = self._get_list_of_packages_to_retrieve(html_to_parse)
+        index_payload = self._get_package_index()
 
-            if len(package_list) > 0:
-                # Get the package info for all the packages
-                self.logger.info("Beginning package information retrieval")
-                files_written = 0
-
-                for package in package_list:
-                    # Get the package data
-                    package_data_json = self._get_json_data_for_package(package)
+        if index_payload:
+            if 'json' in self._index_content_type:
+                package_list = self._get_list_of_packages_from_simple_index(index_payload)
+            else:
+                # Older index servers still answer with HTML
+                package_list = self._get_list_of_packages_to_retrieve(index_payload)
+                if not package_list:
+                    self.logger.warn("No package links found in the HTML index")
+            self._cached_package_list = package_list
+        elif self._index_not_modified:
+            self.logger.info("Reusing the package list from the previous run")
+            package_list = self._cached_package_list
+        else:
+            return
+
+        # Only retrieve packages we don't already have on disk
+        existing_packages = self._get_list_of_existing_packages()
+        package_list = [
+            package for package in package_list
+            if package not in existing_packages
+        ]
 
-                    # If we have package data, save it to disk
+        if len(package_list) > 0:
+            # Get the package info for all the packages
+            self.logger.info("Beginning package information retrieval")
+            files_written = 0
+
+            # The work is network bound, so overlap the package
+            # fetches on a small pool of threads sharing the
+            # keep-alive session
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {
+                    executor.submit(self._fetch_package, package): package
+                    for package in package_list
+                }
+
+                for future in as_completed(futures):
+                    try:
+                        package_data_json = future.result()
+                    except Exception:
+                        self.logger.error("Caught exception fetching package data", extra={
+                            'error_type': 'FetchError',
+                            'package': futures[future],
+                            'ex': traceback.format_exc()
+                        })
+                        continue
+
+                    # If we have package data, save it to disk under the
+                    # name it was fetched as
                     if package_data_json is not None:
-                        if self._save_package_data_to_disk(package_data_json):
+                        if self._save_package_data_to_disk(package_data_json, futures[future]):
                             files_written += 1
 
-                    # Wait a few seconds between getting package data pages
-                    time_to_sleep = random.random() + random.randint(1, 3)
-                    sleep(time_to_sleep)
+            # Make sure every queued write has landed before reporting,
+            # so the next cycle's skip-existing scan sees the files
+            self._write_q.join()
 
-                self.logger.info("{} packages retrieved in this run".format(files_written))
-            else:
-                self.logger.info("No new packages found")
+            self.logger.info("{} packages retrieved in this run".format(files_written))
+        else:
+            self.logger.info("No new packages found")
 
 
 if __name__ == '__main__':
@@ -213,12 +478,18 @@ if __name__ == '__main__':
     random.seed()
 
     scraper = PyPIScraper(pypi_source_page=getenv('PYPI_SOURCE_PAGE'),
+                          pypi_simple_index=getenv('PYPI_SIMPLE_INDEX'),
                           log_level=getenv('LOG_LEVEL'),
                           log_dir=getenv('LOG_DIR'),
-                          log_file_name=getenv('LOG_FILE_NAME'))
-
-    while True:
-        # Retrieve an update every 7-9 minutes
-        scraper.run()
-        time_to_next_run = (random.random() + random.randint(7, 9)) * 60
-        sleep(time_to_next_run)
+                          log_file_name=getenv('LOG_FILE_NAME'),
+                          max_workers=int(getenv('MAX_WORKERS', 16)),
+                          requests_per_second=float(getenv('REQUESTS_PER_SECOND', 5)))
+
+    try:
+        while True:
+            # Retrieve an update every 7-9 minutes
+            scraper.run()
+            time_to_next_run = (random.random() + random.randint(7, 9)) * 60
+            sleep(time_to_next_run)
+    finally:
+        scraper.close()
@@ -5,9 +5,11 @@
 
 import pytest
 from mock import MagicMock, patch
+import requests
 from requests.exceptions import ConnectionError
-from pypi_scraper.pypi_scraper import PyPIScraper
+from pypi_scraper.pypi_scraper import PyPIScraper, TokenBucket
 from scutils.log_factory import LogObject
+from time import monotonic
 import json
 
 
@@ -20,6 +22,38 @@ def pypi_scraper():
 
     return pypi_scraper_instance
 
+
+@pytest.fixture()
+def pypi_homepage_source():
+    """Raw bytes of the PyPI homepage fixture."""
+    with open('tests/data/pypi_homepage_correct.htm', 'rb') as source_file:
+        return source_file.read()
+
+class TestTokenBucket(object):
+    """Test the token bucket rate limiter"""
+
+    def test_burst_within_capacity_does_not_wait(self):
+        """Ensure acquires within the bucket capacity return immediately."""
+        bucket = TokenBucket(rate=1, capacity=3)
+
+        start = monotonic()
+        for _ in range(3):
+            bucket.acquire()
+
+        assert monotonic() - start < 0.5
+
+    def test_acquires_beyond_capacity_are_rate_limited(self):
+        """Ensure acquires beyond the bucket capacity wait for the refill."""
+        bucket = TokenBucket(rate=50, capacity=1)
+
+        start = monotonic()
+        for _ in range(6):
+            bucket.acquire()
+
+        # Five of the six acquires had to wait for a token at 50/s
+        assert monotonic() - start >= 0.1
+
+
 class TestPyPIScraper(object):
     """Test the PyPI Scraper"""
 
@@ -28,6 +62,12 @@ class TestPyPIScraper(object):
         pypi_scraper._setup()
         assert isinstance(pypi_scraper.logger, LogObject)
 
+    def test_setup_creates_session(self, pypi_scraper):
+        """Ensure _setup creates the shared requests session."""
+        pypi_scraper._setup()
+        assert isinstance(pypi_scraper.session, requests.Session)
+        assert pypi_scraper.session.headers['User-Agent'] == 'pypi-scraper'
+
     def test_get_list_of_existing_packages_returns_proper_file_list(self, pypi_scraper, tmpdir):
         """Ensure we can get the existing list of package files the scraper has already created."""
         pypi_scraper._setup()
@@ -37,19 +77,21 @@ class TestPyPIScraper(object):
         temp_path.join("test1.json").write("content")
         temp_path.join("test2.json").write("content")
         temp_path.join("test3.json").write("content")
+        temp_path.join("notes.txt").write("content")
 
         pypi_scraper.base_save_path = temp_path
 
         package_list = pypi_scraper._get_list_of_existing_packages()
 
+        assert isinstance(package_list, set)
         assert len(package_list) == 3
         assert "test1" in package_list
         assert "test2" in package_list
         assert "test3" in package_list
         assert "test4" not in package_list
 
-    def test_get_pypi_page_returns_html_or_none(self, pypi_scraper):
-        """Ensure the PyPI homepage HTML is returned or None if not."""
+    def test_get_package_index_returns_payload_or_none(self, pypi_scraper):
+        """Ensure the package index payload is returned or None if not."""
         pypi_scraper._setup()
 
         mock_success = MagicMock()
@@ -60,41 +102,59 @@ class TestPyPIScraper(object):
         mock_failure.status_code = 404
         mock_failure.return_value = None
 
-        with patch('pypi_scraper.pypi_scraper.requests') as mock_requests:
-            mock_requests.return_value = mock_requests
-            mock_requests.get = MagicMock(side_effect=[mock_success])
-
-            result = pypi_scraper._get_pypi_homepage()
+        with patch.object(pypi_scraper.session, 'get', side_effect=[mock_success]):
+            result = pypi_scraper._get_package_index()
 
             assert result is not None
 
-        with patch('pypi_scraper.pypi_scraper.requests') as mock_requests:
-            mock_requests.return_value = mock_requests
-            mock_requests.get = MagicMock(side_effect=[mock_failure])
-
-            result = pypi_scraper._get_pypi_homepage()
+        with patch.object(pypi_scraper.session, 'get', side_effect=[mock_failure]):
+            result = pypi_scraper._get_package_index()
 
             assert result is None
 
-    def test_get_pypi_page_retries_on_connection_error(self, pypi_scraper):
-        """Ensure the proper error, if one occurs, is returned when obtaining the PyPI homepage."""
+    def test_get_package_index_retries_on_connection_error(self, pypi_scraper):
+        """Ensure the proper error, if one occurs, is returned when obtaining the package index."""
         pypi_scraper._setup()
 
         mock_conn_err = ConnectionError()
         mock_success = MagicMock()
         mock_success.status_code = 200
 
-        with patch('pypi_scraper.pypi_scraper.requests') as mock_requests:
-            mock_requests.return_value = mock_requests
-            mock_requests.get = MagicMock(side_effect=[mock_conn_err, mock_conn_err, mock_success])
-
+        with patch.object(pypi_scraper.session, 'get', side_effect=[mock_conn_err, mock_conn_err, mock_success]):
             pypi_scraper.logger.error = MagicMock()
 
-            pypi_scraper._get_pypi_homepage()
+            pypi_scraper._get_package_index()
 
             assert pypi_scraper.logger.error.call_count == 2
 
-    def test_get_list_of_packages_to_retrieve_returns_proper_package_list(self, pypi_scraper):
+    def test_get_package_index_makes_conditional_requests(self, pypi_scraper):
+        """Ensure index validators are stored and a 304 flags the cached list for reuse."""
+        pypi_scraper._setup()
+
+        mock_success = MagicMock()
+        mock_success.status_code = 200
+        mock_success.headers = {'ETag': '"abc123"',
+                                'Last-Modified': 'Mon, 02 Jan 2017 00:00:00 GMT'}
+
+        mock_not_modified = MagicMock()
+        mock_not_modified.status_code = 304
+
+        with patch.object(pypi_scraper.session, 'get',
+                          side_effect=[mock_success, mock_not_modified]) as mock_get:
+            result = pypi_scraper._get_package_index()
+
+            assert result is not None
+            assert pypi_scraper._index_etag == '"abc123"'
+
+            result = pypi_scraper._get_package_index()
+
+            assert result is None
+            assert pypi_scraper._index_not_modified
+
+            args, kwargs = mock_get.call_args
+            assert kwargs['headers']['If-None-Match'] == '"abc123"'
+
+    def test_get_list_of_packages_to_retrieve_returns_proper_package_list(self, pypi_scraper, pypi_homepage_source):
         """Ensure the proper list and count of packages is extracted from the source HTML."""
         pypi_scraper._setup()
 
@@ -106,40 +166,78 @@ class TestPyPIScraper(object):
                                  'nodewire', 'pykafka-tools', 'commandlib', 'psmtool', 'fints', 'mr_bot', 'pycricbuzz',
                                  'alignak_demo', 'primesieve', 'vcdriver', 'ti']
 
-        with open('tests/data/pypi_homepage_correct.htm') as source_file:
-            result = pypi_scraper._get_list_of_packages_to_retrieve(source_file)
+        result = pypi_scraper._get_list_of_packages_to_retrieve(pypi_homepage_source)
+
+        assert len(result) == 40
+        for package in expected_package_list:
+            assert package in result
+
+    def test_get_list_of_packages_to_retrieve_accepts_str_and_bytes(self, pypi_scraper, pypi_homepage_source):
+        """Ensure str and bytes page source extract the same package list."""
+        pypi_scraper._setup()
 
-            assert len(result) == 40
-            for package in expected_package_list:
-                assert package in result
+        from_bytes = pypi_scraper._get_list_of_packages_to_retrieve(pypi_homepage_source)
+        from_str = pypi_scraper._get_list_of_packages_to_retrieve(pypi_homepage_source.decode('utf-8'))
+
+        assert from_bytes == from_str
+        assert len(from_bytes) == 40
+
+    def test_get_list_of_packages_to_retrieve_reads_simple_index_anchors(self, pypi_scraper):
+        """Ensure PEP 503 style simple index pages are recognized too."""
+        pypi_scraper._setup()
+
+        source = (b'<html><body>'
+                  b'<a href="/simple/flask/">flask</a>'
+                  b'<a href="/simple/requests/">requests</a>'
+                  b'</body></html>')
+
+        result = pypi_scraper._get_list_of_packages_to_retrieve(source)
+
+        assert result == ['flask', 'requests']
+
+    def test_get_list_of_packages_to_retrieve_falls_back_to_parser(self, pypi_scraper):
+        """Ensure markup the fast-path regex can't match still goes through the parser."""
+        pypi_scraper._setup()
+
+        # Single-quoted attributes defeat the regex but not the parser
+        source = b"<table class='list'><tr><td><a href='/pypi/flask/0.12'>flask 0.12</a></td></tr></table>"
+
+        result = pypi_scraper._get_list_of_packages_to_retrieve(source)
+
+        assert result == ['flask']
+
+    def test_get_list_of_packages_from_simple_index_returns_proper_package_list(self, pypi_scraper):
+        """Ensure the package names are extracted from a json simple index payload."""
+        pypi_scraper._setup()
+
+        payload = json.dumps({'projects': [{'name': 'flask'}, {'name': 'requests'}]})
+
+        result = pypi_scraper._get_list_of_packages_from_simple_index(payload)
+
+        assert result == ['flask', 'requests']
 
     def test_get_json_data_for_package_returns_json_or_none(self, pypi_scraper):
         """Ensure the json data for a package is returned or None if not."""
         pypi_scraper._setup()
 
-        with open('tests/data/flask.json') as source_file:
-            flask_json = json.load(source_file)
+        with open('tests/data/flask.json', 'rb') as source_file:
+            flask_bytes = source_file.read()
 
             mock_success = MagicMock()
             mock_success.status_code = 200
-            mock_success.return_value = flask_json
+            mock_success.content = flask_bytes
 
             mock_failure = MagicMock()
             mock_failure.status_code = 404
             mock_failure.return_value = None
 
-            with patch('pypi_scraper.pypi_scraper.requests') as mock_requests:
-                mock_requests.return_value = mock_requests
-                mock_requests.get = MagicMock(side_effect=[mock_success])
-
+            with patch.object(pypi_scraper.session, 'get', side_effect=[mock_success]):
                 result = pypi_scraper._get_json_data_for_package(package='flask')
 
                 assert result is not None
+                assert result['info']['name'] == 'Flask'
 
-            with patch('pypi_scraper.pypi_scraper.requests') as mock_requests:
-                mock_requests.return_value = mock_requests
-                mock_requests.get = MagicMock(side_effect=[mock_failure])
-
+            with patch.object(pypi_scraper.session, 'get', side_effect=[mock_failure]):
                 result = pypi_scraper._get_json_data_for_package(package='flask')
 
                 assert result is None
@@ -151,17 +249,27 @@ class TestPyPIScraper(object):
         mock_conn_err = ConnectionError()
         mock_success = MagicMock()
         mock_success.status_code = 200
+        mock_success.content = b'{}'
 
-        with patch('pypi_scraper.pypi_scraper.requests') as mock_requests:
-            mock_requests.return_value = mock_requests
-            mock_requests.get = MagicMock(side_effect=[mock_conn_err, mock_conn_err, mock_success])
-
+        with patch.object(pypi_scraper.session, 'get', side_effect=[mock_conn_err, mock_conn_err, mock_success]):
             pypi_scraper.logger.error = MagicMock()
 
             pypi_scraper._get_json_data_for_package(package='flask')
 
             assert pypi_scraper.logger.error.call_count == 2
 
+    def test_write_package_file_writes_atomically(self, pypi_scraper, tmpdir):
+        """Ensure the package file lands complete with no temp file left behind."""
+        pypi_scraper._setup()
+
+        temp_path = tmpdir.mkdir("data")
+        file_name = str(temp_path.join("flask.json"))
+
+        pypi_scraper._write_package_file(file_name, b'{"info":{"name":"Flask"}}')
+
+        assert temp_path.join("flask.json").read_binary() == b'{"info":{"name":"Flask"}}'
+        assert not temp_path.join("flask.json.tmp").check()
+
     def test_save_package_data_to_disk_properly_saves_file_to_disk(self, pypi_scraper, tmpdir):
         """Ensure the package json file is properly saved to disk."""
         pypi_scraper._setup()
@@ -175,6 +283,18 @@ class TestPyPIScraper(object):
             result = pypi_scraper._save_package_data_to_disk(flask_json)
             assert result
 
+            # The write happens on the writer thread; wait for it to land
+            pypi_scraper._write_q.join()
+            assert temp_path.join("Flask.json").check()
+
+            # The fetched name wins over the registered name, so the
+            # file matches the skip-existing diff on the next run
+            result = pypi_scraper._save_package_data_to_disk(flask_json, package='flask')
+            assert result
+
+            pypi_scraper._write_q.join()
+            assert temp_path.join("flask.json").check()
+
         with pytest.raises(Exception) as context:
             package_json = None
             result = pypi_scraper._save_package_data_to_disk(package_json)